@@ -4,7 +4,14 @@ import matplotlib.pyplot as plt
 import sys
 import os
 import argparse
+import hashlib
 import scipy.io as sio
+from scipy.spatial import cKDTree
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 
 # argument parsing
@@ -24,122 +31,179 @@ parse.add_argument("-e", "--data_set", default="none", type=str, help="Data set
 
 ARGS = parse.parse_args()
 
+# precomputed RGB colors for valid (distance lookup table) and invalid (uniform) points
+_HOT_R = plt.get_cmap("hot_r")
+_WINTER = plt.get_cmap("winter")
+
+HOT_LUT = _HOT_R(np.linspace(0, 1, 256))[:, :3]
+HOT_LUT.setflags(write=False)
+WINTER_RGB = np.asarray(_WINTER(1.0)[:3])
+WINTER_RGB.setflags(write=False)
 
-def correct_round(n):
-    return np.round(n+0.5)
 
-def read_point_cloud(ply_path, size=0.1):
+def read_point_cloud(ply_path, size=0.1, cache_path=None):
     if(ply_path[-3:] != "ply"):
         print("{} is not a '.ply' file.".format(ply_path))
         sys.exit()
 
+    # look for a previously downsampled cloud (keyed on file, modification time, and voxel size)
+    cache_file = None
+    if cache_path is not None:
+        key = "{}_{}_{}".format(os.path.abspath(ply_path), os.path.getmtime(ply_path), size)
+        cache_file = os.path.join(cache_path, "{}.npz".format(hashlib.md5(key.encode()).hexdigest()))
+
+        if os.path.exists(cache_file):
+            ply = o3d.geometry.PointCloud()
+            with np.load(cache_file) as data:
+                ply.points = o3d.utility.Vector3dVector(data["points"])
+                if "normals" in data:
+                    ply.normals = o3d.utility.Vector3dVector(data["normals"])
+                if "colors" in data:
+                    ply.colors = o3d.utility.Vector3dVector(data["colors"])
+            return ply
+
     ply = o3d.io.read_point_cloud(ply_path)
     ply = ply.voxel_down_sample(voxel_size=size)
 
-    return ply
-
-def build_src_points_filter(ply, min_bound, res, mask):
-    points = np.asarray(ply.points).transpose()
-    shape = points.shape
-    mask_shape = mask.shape
-    filt = np.zeros(shape[1])
+    # store the downsampled cloud (points plus any normals/colors) for subsequent runs
+    if cache_file is not None:
+        os.makedirs(cache_path, exist_ok=True)
+
+        arrays = {"points": np.asarray(ply.points)}
+        if ply.has_normals():
+            arrays["normals"] = np.asarray(ply.normals)
+        if ply.has_colors():
+            arrays["colors"] = np.asarray(ply.colors)
+
+        # write to a temporary file first so an interrupted run never leaves a truncated cache entry
+        tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        try:
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_file, cache_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
 
-    min_bound = min_bound.reshape(3,1)
-    min_bound = np.tile(min_bound, (1,shape[1]))
+    return ply
 
-    qv = points
-    qv = (points - min_bound) / res
-    qv = correct_round(qv).astype(int)
+if njit is not None:
+    # (cache=True persists the compiled kernel so repeated CLI runs skip the JIT compile)
+    @njit(parallel=True, cache=True)
+    def _voxel_filter(points, min_bound, res, mask_flat, shape0, shape1, shape2, out):
+        # quantize, bounds-check, and look up the mask for every point in a single pass
+        # (quantization must match the NumPy path below, including half-to-even ties)
+        for i in prange(points.shape[0]):
+            ix = int(np.rint((points[i,0] - min_bound[0]) / res + 0.5))
+            iy = int(np.rint((points[i,1] - min_bound[1]) / res + 0.5))
+            iz = int(np.rint((points[i,2] - min_bound[2]) / res + 0.5))
+
+            if (ix >= 0 and ix < shape0 and iy >= 0 and iy < shape1 and iz >= 0 and iz < shape2):
+                out[i] = mask_flat[(ix*shape1*shape2) + (iy*shape2) + iz]
+            else:
+                out[i] = False
+else:
+    _voxel_filter = None
+
+def build_src_points_filter(points, min_bound, res, mask):
+    filt = np.zeros(points.shape[0], dtype=bool)
+
+    # use the fused kernel when numba is available
+    if _voxel_filter is not None:
+        _voxel_filter(np.ascontiguousarray(points), np.asarray(min_bound, dtype=np.float64), float(res), \
+                np.ascontiguousarray(mask).ravel(), mask.shape[0], mask.shape[1], mask.shape[2], filt)
+        return filt
+
+    # quantize points into mask voxel coordinates (broadcast min_bound over all points)
+    # (np.rint rounds halves to even, so points exactly on a voxel boundary keep their original voxel)
+    qv = np.rint((points - min_bound) / res + 0.5).astype(np.int32)
 
     # get all valid points
-    in_bounds = np.asarray(np.where( ((qv[0,:]>=0) & (qv[0,:] < mask_shape[0]) & (qv[1,:]>=0) & (qv[1,:] < mask_shape[1]) & (qv[2,:]>=0) & (qv[2,:] < mask_shape[2])))).squeeze(0)
-    valid_points = qv[:,in_bounds]
+    in_bounds = np.flatnonzero(((qv >= 0) & (qv < np.asarray(mask.shape))).all(axis=1))
+    valid_points = qv[in_bounds]
 
     # convert 3D coords ([x,y,z]) to appropriate flattened coordinate ((x*mask_shape[1]*mask_shape[2]) + (y*mask_shape[2]) + z )
-    mask_inds = np.ravel_multi_index(valid_points, dims=mask.shape, order='C')
+    # (cast the in-bounds coordinates to intp so the products cannot overflow int32)
+    valid_points = valid_points.astype(np.intp)
+    stride1 = mask.shape[2]
+    stride0 = mask.shape[1] * stride1
+    mask_inds = valid_points[:,0]*stride0 + valid_points[:,1]*stride1 + valid_points[:,2]
 
     # further trim down valid points by mask value (keep point if mask is True)
-    mask = mask.flatten()
-    valid_mask_points = np.asarray(np.where(mask[mask_inds] == True)).squeeze(0)
+    keep = mask.ravel()[mask_inds]
 
-    # add 1 to indices where we want to keep points
-    filt[in_bounds[valid_mask_points]] = 1
+    # mark indices where we want to keep points
+    filt[in_bounds[keep]] = True
 
     return filt
 
-def build_tgt_points_filter(ply, P):
-    points = np.asarray(ply.points).transpose()
-    shape = points.shape
-
-    # compute iner-product between points and the defined plane
-    Pt = P.transpose()
-
-    points = np.concatenate((points, np.ones((1,shape[1]))), axis=0)
-    plane_prod = (Pt @ points).squeeze(0)
+def build_tgt_points_filter(points, P):
+    # compute inner-product between points and the defined plane (P = [n; d], shape (4,1))
+    plane_prod = points @ P[:3,0] + P[3,0]
 
     # get all valid points
-    filt = np.asarray(np.where((plane_prod > 0), 1, 0))
+    filt = plane_prod > 0
 
     return filt
 
-def compare_point_clouds(src_ply, tgt_ply, max_dist, src_filt, tgt_filt):
+def query_distances(tree, points, chunk_size=1<<20):
+    # query nearest-neighbor distances in fixed-size chunks to bound peak memory (indices are discarded)
+    dists = np.empty(points.shape[0])
+    for i in range(0, points.shape[0], chunk_size):
+        dists[i:i+chunk_size], _ = tree.query(points[i:i+chunk_size], k=1, workers=-1)
+
+    return dists
+
+def compare_point_clouds(src_ply, tgt_ply, src_points, tgt_points, max_dist, src_filt, tgt_filt):
     # compute bi-directional distance between point clouds
     md = 20
 
-    dists_src = np.asarray(src_ply.compute_point_cloud_distance(tgt_ply))
-    valid_inds_src = set(np.where(src_filt == 1)[0])
-    valid_dists = set(np.where(dists_src <= md)[0])
-    valid_inds_src.intersection_update(valid_dists)
-    valid_inds_src = np.asarray(list(valid_inds_src))
-    dists_src = dists_src[valid_inds_src]
+    # build each KD-tree once and reuse it for its direction of the query
+    src_tree = cKDTree(src_points, leafsize=32)
+    tgt_tree = cKDTree(tgt_points, leafsize=32)
+
+    dists_src = query_distances(tgt_tree, src_points)
+    valid_mask_src = src_filt & (dists_src <= md)
+    dists_src = dists_src[valid_mask_src]
 
-    dists_tgt = np.asarray(tgt_ply.compute_point_cloud_distance(src_ply))
-    valid_inds_tgt = set(np.where(tgt_filt == 1)[0])
-    valid_dists = set(np.where(dists_tgt <= md)[0])
-    valid_inds_tgt.intersection_update(valid_dists)
-    valid_inds_tgt = np.asarray(list(valid_inds_tgt))
-    dists_tgt = dists_tgt[valid_inds_tgt]
+    dists_tgt = query_distances(src_tree, tgt_points)
+    valid_mask_tgt = tgt_filt & (dists_tgt <= md)
+    dists_tgt = dists_tgt[valid_mask_tgt]
 
     # compute accuracy and competeness
     acc = np.mean(dists_src)
     comp = np.mean(dists_tgt)
 
     # measure incremental precision and recall values with thesholds from (0, 10*max_dist)
+    # (sort once so each threshold count is a binary search instead of a full pass)
+    sorted_dists_src = np.sort(dists_src)
+    sorted_dists_tgt = np.sort(dists_tgt)
     th_vals = np.linspace(0, 3*max_dist, num=50)
-    prec_vals = [ (len(np.where(dists_src <= th)[0]) / len(dists_src)) for th in th_vals ]
-    rec_vals = [ (len(np.where(dists_tgt <= th)[0]) / len(dists_tgt)) for th in th_vals ]
+    prec_vals = np.searchsorted(sorted_dists_src, th_vals, side='right') / sorted_dists_src.size
+    rec_vals = np.searchsorted(sorted_dists_tgt, th_vals, side='right') / sorted_dists_tgt.size
 
     # compute precision and recall for given distance threshold
-    prec = len(np.where(dists_src <= max_dist)[0]) / len(dists_src)
-    rec = len(np.where(dists_tgt <= max_dist)[0]) / len(dists_tgt)
-
-    # color point cloud for precision
-    valid_src_ply = src_ply.select_by_index(valid_inds_src)
-    src_size = len(valid_src_ply.points)
-    cmap = plt.get_cmap("hot_r")
-    colors = cmap(np.minimum(dists_src, max_dist) / max_dist)[:, :3]
-    valid_src_ply.colors = o3d.utility.Vector3dVector(colors)
-
-    # color invalid points precision
-    invalid_src_ply = src_ply.select_by_index(valid_inds_src, invert=True)
-    cmap = plt.get_cmap("winter")
-    colors = cmap(np.ones(len(invalid_src_ply.points)))[:, :3]
-    invalid_src_ply.colors = o3d.utility.Vector3dVector(colors)
-
-    # color point cloud for recall
-    valid_tgt_ply = tgt_ply.select_by_index(valid_inds_tgt)
-    tgt_size = len(valid_tgt_ply.points)
-    cmap = plt.get_cmap("hot_r")
-    colors = cmap(np.minimum(dists_tgt, max_dist) / max_dist)[:, :3]
-    valid_tgt_ply.colors = o3d.utility.Vector3dVector(colors)
-
-    # color invalid points recall
-    invalid_tgt_ply = tgt_ply.select_by_index(valid_inds_tgt, invert=True)
-    cmap = plt.get_cmap("winter")
-    colors = cmap(np.ones(len(invalid_tgt_ply.points)))[:, :3]
-    invalid_tgt_ply.colors = o3d.utility.Vector3dVector(colors)
-
-    return (valid_src_ply + invalid_src_ply, valid_tgt_ply + invalid_tgt_ply), (acc,comp), (prec, rec), (th_vals, prec_vals, rec_vals), (src_size, tgt_size)
+    prec = np.searchsorted(sorted_dists_src, max_dist, side='right') / sorted_dists_src.size
+    rec = np.searchsorted(sorted_dists_tgt, max_dist, side='right') / sorted_dists_tgt.size
+
+    # color point cloud for precision (valid points by distance, invalid points uniformly)
+    src_size = dists_src.size
+    lut_inds = np.minimum(dists_src * (len(HOT_LUT) / max_dist), len(HOT_LUT)-1).astype(np.uint8)
+    colors = np.empty((len(src_points), 3))
+    colors[valid_mask_src] = HOT_LUT[lut_inds]
+    colors[~valid_mask_src] = WINTER_RGB
+    src_ply.colors = o3d.utility.Vector3dVector(colors)
+
+    # color point cloud for recall (valid points by distance, invalid points uniformly)
+    tgt_size = dists_tgt.size
+    lut_inds = np.minimum(dists_tgt * (len(HOT_LUT) / max_dist), len(HOT_LUT)-1).astype(np.uint8)
+    colors = np.empty((len(tgt_points), 3))
+    colors[valid_mask_tgt] = HOT_LUT[lut_inds]
+    colors[~valid_mask_tgt] = WINTER_RGB
+    tgt_ply.colors = o3d.utility.Vector3dVector(colors)
+
+    return (src_ply, tgt_ply), (acc,comp), (prec, rec), (th_vals, prec_vals, rec_vals), (src_size, tgt_size)
 
 def save_ply(file_path, ply):
     o3d.io.write_point_cloud(file_path, ply)
@@ -169,6 +233,7 @@ def main():
     max_dist = ARGS.max_dist
     data_set = ARGS.data_set
 
+    cache_path = os.path.join(output_path, "_cache")
     output_path = os.path.join(output_path, "{}_{}".format(method, str(scan_num).zfill(3)))
 
     # create output path if it does not exist
@@ -179,8 +244,12 @@ def main():
 
     ##### Load in point clouds #####
     print("Loading point clouds...")
-    src_ply = read_point_cloud(src_path, voxel_size)
-    tgt_ply = read_point_cloud(tgt_path, voxel_size)
+    src_ply = read_point_cloud(src_path, voxel_size, cache_path)
+    tgt_ply = read_point_cloud(tgt_path, voxel_size, cache_path)
+
+    # pull point buffers out of open3d once and share them across all stages
+    src_points = np.asarray(src_ply.points)
+    tgt_points = np.asarray(tgt_ply.points)
 
 
 
@@ -192,7 +261,7 @@ def main():
     bounds = np.asarray(data["BB"])
     min_bound = bounds[0,:]
     max_bound = bounds[1,:]
-    mask = np.asarray(data["ObsMask"])
+    mask = np.asarray(data["ObsMask"], dtype=bool)
     res = int(data["Res"])
 
     # read in matlab gt plane 
@@ -202,17 +271,17 @@ def main():
     P = np.asarray(data["P"])
 
     # build points filter based on input mask
-    src_filt = build_src_points_filter(src_ply, min_bound, res, mask)
+    src_filt = build_src_points_filter(src_points, min_bound, res, mask)
 
     # build points filter based on input mask
-    tgt_filt = build_tgt_points_filter(tgt_ply, P)
+    tgt_filt = build_tgt_points_filter(tgt_points, P)
 
 
 
     ##### Compute metrics between point clouds #####
     print("Computing metrics between point clouds...")
     (precision_ply, recall_ply), (acc,comp), (prec, rec), (th_vals, prec_vals, rec_vals), (src_size, tgt_size) \
-            = compare_point_clouds(src_ply, tgt_ply, max_dist, src_filt, tgt_filt)
+            = compare_point_clouds(src_ply, tgt_ply, src_points, tgt_points, max_dist, src_filt, tgt_filt)
 
 
 
@@ -8,18 +8,18 @@ def create_subfigures(images: List[np.ndarray], captions: List[str], labels: Lis
     num_sub_figs = len(images)
     width_scale = 1/num_sub_figs
 
-    figure = "\\begin{figure}\n"
+    parts = ["\\begin{figure}\n"]
 
     for n in range(num_sub_figs):
-        figure +=   "\t\\centering\n" + \
-                    "\t\\begin{{subfigure}}{{{w:.1f}\\textwidth}}\n".format(w=width_scale) + \
-                        "\t\t\\centering\n" + \
-                        "\t\t\\includegraphics[width=\\textwidth]{{{img}}}\n".format(img=images[n]) + \
-                        "\t\t\\caption{{{caption}}}\n".format(caption=captions[n]) + \
-                        "\t\t\\label{{fig:{label}}}\n".format(label=labels[n]) + \
-                        "\t\\end{subfigure}\n\t\\hfill\n"
-    figure +=   "\t\\caption{{{caption}}}\n".format(caption=captions[-1]) + \
-                "\t\\label{{fig:{label}}}\n".format(label=labels[-1]) + \
-                "\\end{figure}"
+        parts.append(f"\t\\centering\n"
+                     f"\t\\begin{{subfigure}}{{{width_scale:.1f}\\textwidth}}\n"
+                     f"\t\t\\centering\n"
+                     f"\t\t\\includegraphics[width=\\textwidth]{{{images[n]}}}\n"
+                     f"\t\t\\caption{{{captions[n]}}}\n"
+                     f"\t\t\\label{{fig:{labels[n]}}}\n"
+                     f"\t\\end{{subfigure}}\n\t\\hfill\n")
+    parts.append(f"\t\\caption{{{captions[-1]}}}\n"
+                 f"\t\\label{{fig:{labels[-1]}}}\n"
+                 f"\\end{{figure}}")
 
-    return figure
+    return "".join(parts)